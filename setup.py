@@ -7,7 +7,8 @@ setup(
     install_requires=[
         "tkinter",
         "Pillow",
-        "google-generativeai",
+        "numpy",
+        "google-generativeai==0.8.6",
         "cryptography",
         "exif",
         "pywin32",
@@ -15,6 +16,7 @@ setup(
     entry_points={
         "console_scripts": [
             "image_caption_app=app:main",
+            "tagline=app:main",
         ],
     },
     author="Milky99",